@@ -2,60 +2,77 @@
 """Format LaTeX source code"""
 # Copyright (C) 2017 Michael Goerz. See LICENSE for terms of use.
 import logging
-import fileinput
+import concurrent.futures
+import functools
+import itertools
 import textwrap
 import re
-import sys
 
 import click
 
+logger = logging.getLogger(__name__)
+
 RX_LATEX_COMMAND = re.compile(r'\s*\\')
-RX_LATEX_SECTION = re.compile(
-    r'\s*\\(part|chapter|section|subsection|subsubsection|image)')
-RX_LATEX_COMMENT = re.compile(
-    r'(.*[^\\]|\s*)%.*')
-RX_LATEX_BEGIN = re.compile(r'\\begin')
-RX_LATEX_BEGIN_DOC = re.compile(r'\\begin\{(document|abstract)')
-RX_LATEX_END = re.compile(r'\\end')
-RX_LATEX_END_DOC = re.compile(r'\\end\{(document|abstract)')
+RX_LATEX_PROTECTED = re.compile(
+    # commands that protect a line if they are at its start
+    r'\s*\\(?:part|chapter|section|subsection|subsubsection|image)'
+    r'|\\(?:begin|end)\{(?:document|abstract)')
 RX_EMPTY_LINE = re.compile(r'\s*$')
 RX_FULL_STOP = re.compile(
     # sentence ending period only
-    r'(?<=([\@$}\'0-9a-z]))\.(?![,\w\\~])')
-
+    r'(?<=[\@$}\'0-9a-z])\.(?![,\w\\~])')
+RX_SPACES = re.compile(r'( +)')
+# whitespace that textwrap does not simply treat as a word separator
+RX_SPECIAL_WHITESPACE = re.compile(r'[^\S \n\x0b\x0c\r]')
+# whitespace that textwrap replaces by a single space (except for tabs,
+# which it expands)
+WHITESPACE_TO_SPACE = {ord(c): ' ' for c in '\n\x0b\x0c\r'}
+BLOCK_SIZE = 1 << 20  # number of characters to read from input at a time
 
-def split_first_sentence(line):
-    """Split the line at the first full stop. If there is no full stop, return
-    tupel (line, '')"""
-    try:
-        m = next(RX_FULL_STOP.finditer(line))
-    except StopIteration:
-        return line, ''
-    else:
-        pos = m.span()[1]
-        return line[:pos], line[pos:].lstrip()
 
+def find_comment(line):
+    """Return the index of the first unescaped '%' in `line`, or -1 if `line`
+    does not contain a comment"""
+    i = line.find('%')
+    while i != -1:
+        if i == 0 or line[i-1] != '\\':
+            return i
+        i = line.find('%', i+1)
+    return -1
 
-def ends_with_full_stop(line):
-    """Check whether the given `line` ends with full stop (ignoring
-    whitespace)"""
-    if RX_FULL_STOP.search(line.rstrip()[-2:]):
-        return True
-    else:
-        return False
 
+def classify_line(line):
+    """Classify the given (stripped) `line`
 
-def is_protected(line):
-    """Check whether the given line is "protected". Protected lines must stay
-    isolated, they are not concatenated with previous or following lines"""
+    Returns:
+        A tuple `protect`, `tally`, where `protect` indicates whether the line
+        is "protected", and `tally` is the result of :func:`group_tally` for
+        an unprotected line, or zero for a protected line. Protected lines
+        (comments, sectioning commands, and the beginning/end of the document
+        or abstract) must stay isolated; they are not concatenated with
+        previous or following lines.
+    """
     # TODO: recognize more things that should stay on their own line, e.g.
     # command definitions
-    rxs = [RX_LATEX_COMMENT, RX_LATEX_SECTION, RX_LATEX_BEGIN_DOC,
-           RX_LATEX_END_DOC]
-    for rx in rxs:
-        if rx.match(line):
-            return True
-    return False
+    if find_comment(line) >= 0:
+        return True, 0
+    if '\\' not in line:  # no LaTeX commands at all
+        return False, 0
+    return classify_commands(line)
+
+
+@functools.lru_cache(maxsize=4096)
+def classify_commands(line):
+    r"""Classify the given (stripped) `line`, which must not contain a
+    comment, based on the LaTeX commands in it. The result is as for
+    :func:`classify_line`.
+
+    Results are cached, as LaTeX documents tend to repeat many short lines
+    with commands (e.g. ``\item``, ``\end{equation}``).
+    """
+    if RX_LATEX_PROTECTED.match(line) is not None:
+        return True, 0
+    return False, group_tally(line)
 
 
 def group_tally(line):
@@ -65,139 +82,236 @@ def group_tally(line):
     A positive number indicates that the line opens groups, and a negative
     number indicates that it closes groups.
     """
-    n_begin = len(RX_LATEX_BEGIN.findall(line))
-    n_end = len(RX_LATEX_END.findall(line))
-    return n_begin - n_end
+    return line.count(r'\begin') - line.count(r'\end')
 
 
-def process_line(cat_buffer, line, open_groups):
+def process_line(line, cat_buffer, open_groups):
     r"""Process a single line of LaTeX text
 
     Args:
-        cat_buffer (str)
         line (str)
+        cat_buffer (list): fragments of text that are to be joined by spaces
         open_groups(int)
 
-    Returns:
-        A tuple `cat_buffer`, `line`, `open_groups`, `ready_for_output`,
-        `protect`, with values as follows:
-
-        * `cat_buffer` is the input `cat_buffer`, possibly extended with data
-          from the input `line`
-        * `line` is the remainder of the input `line` that is left unprocessed
-          If non-emtpy, the output `line` should be passed to another
-          invocation of :func:`process_line`
+    Yields:
+        A tuple `fragments`, `protect`, `open_groups` for every chunk of text
+        that is ready to be put out, where
+
+        * `fragments` is a list of fragments of text (cf. :func:`reflow`)
+        * `protect` indicates that `fragments` should be written without
+          reflowing
         * `open_groups` is the updated number of open groups (things between
-          \begin{...} and \end{...}). That is, the input `open_groups` adjusted
-          by the groups opened/closed in the input `line`
-        * `ready_for_output` is a value that indicates that the output
-          `cat_buffer` is ready to be put out
-        * `protect` indicates that (assuming `ready_for_output`), the output
-          `cat_buffer` should be written without reflowing
+          \begin{...} and \end{...}). That is, the input `open_groups`
+          adjusted by the groups opened/closed in the input `line` so far
+
+    Any fragments of an incomplete sentence remain in `cat_buffer` (which is
+    modified in place) once the iteration is finished.
     """
-    logger = logging.getLogger(__name__)
-    logger.debug("process_line: %s", line)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("process_line: %r", line)
     l = line.strip()
-    line_group_tally = 0
-    ready_for_output = False
-    protect = is_protected(l)
-    in_group = False
-    if not protect:
-        line_group_tally = group_tally(l)
-        if line_group_tally == 0 and open_groups == 0:
-            first_sentence, rest = split_first_sentence(l)
-            if len(cat_buffer) > 0:
-                cat_buffer += " %s" % first_sentence
-            else:
-                cat_buffer = first_sentence
-            line = rest
-            if (len(rest) > 0) or ends_with_full_stop(first_sentence):
-                ready_for_output = True
-        else:
-            in_group = True
-    if in_group:
-        protect = True
-    if protect:
-        if len(cat_buffer) == 0:
-            cat_buffer = line.rstrip()
-            line, ready_for_output = '', True
-            open_groups += line_group_tally
+    protect, line_group_tally = classify_line(l)
+    if protect or line_group_tally != 0 or open_groups != 0:
+        if len(cat_buffer) > 0:
+            yield cat_buffer[:], False, open_groups
+            del cat_buffer[:]
+        open_groups += line_group_tally
+        yield [line.rstrip()], True, open_groups
+        return
+    start = 0  # beginning of the current sentence in `l`
+    for m in (RX_FULL_STOP.finditer(l) if '.' in l else []):
+        cat_buffer.append(l[start:m.end()])
+        yield cat_buffer[:], False, open_groups
+        del cat_buffer[:]
+        rest = l[m.end():].lstrip()
+        if len(rest) == 0:
+            return
+        start = len(l) - len(rest)
+        if '\\' in rest:
+            # The remainder may start a protected command or open a group
+            # by itself
+            protect, rest_group_tally = classify_line(rest)
+            if protect or rest_group_tally != 0:
+                open_groups += rest_group_tally
+                yield [rest], True, open_groups
+                return
+    cat_buffer.append(l[start:])
+
+
+@functools.lru_cache(maxsize=8)
+def text_wrapper(width):
+    """Return a :class:`textwrap.TextWrapper` that wraps at the given `width`
+    without breaking words. Instances are cached, as setting them up is
+    relatively expensive"""
+    return textwrap.TextWrapper(
+        width=width, break_on_hyphens=False, break_long_words=False)
+
+
+def fill(text, width):
+    """Wrap the given `text` (which must not have leading or trailing
+    whitespace) to lines of at most `width` characters, breaking only at
+    whitespace.
+
+    The result is the same as that of ``textwrap.fill(text, width=width,
+    break_on_hyphens=False, break_long_words=False)``, but this greedy
+    single-pass implementation is considerably faster.
+    """
+    if len(text) <= width and text.isprintable():
+        # Fits on a single line, and contains no whitespace other than plain
+        # spaces (which are all kept). This is the common case when
+        # re-formatting already formatted text
+        return text
+    if RX_SPECIAL_WHITESPACE.search(text):
+        # textwrap expands tabs depending on their column, and drops
+        # non-ASCII whitespace at the beginning and end of lines
+        return text_wrapper(width).fill(text)
+    # words and the gaps between them alternate
+    words = RX_SPACES.split(text.translate(WHITESPACE_TO_SPACE))
+    lines = []
+    line = [words[0]]
+    line_len = len(words[0])
+    for i in range(1, len(words), 2):
+        gap, word = words[i], words[i+1]
+        chunk_len = len(gap) + len(word)
+        if line_len + chunk_len <= width:
+            line.append(gap)
+            line.append(word)
+            line_len += chunk_len
         else:
-            # leave line for next call
-            ready_for_output = True
-            protect = False
-    logger.debug(
-        ("  -> cat_buffer '%s', line '%s', open_groups %s, "
-         "ready_for_output %s, protect %s"), cat_buffer, line, open_groups,
-        ready_for_output, protect)
-    return cat_buffer, line, open_groups, ready_for_output, protect
+            lines.append(''.join(line))
+            line = [word]
+            line_len = len(word)
+    lines.append(''.join(line))
+    return "\n".join(lines)
 
 
-def reflow(text, width, protect):
-    """Reflow the given `text` with line width `width`
+def reflow(cat_buffer, width, protect):
+    """Join the fragments of text in the given `cat_buffer` with spaces, and
+    reflow the result with line width `width`
 
-    Return unchanged `text` if `protect` is True.
+    Return the joined text unchanged if `protect` is True.
     """
+    text = " ".join(cat_buffer)
     if protect:
         return text
     else:
-        dedented_text = textwrap.dedent(text.strip())
-        wrapped_text = textwrap.fill(
-            dedented_text, width=width, break_on_hyphens=False,
-            break_long_words=False)
-        return wrapped_text
+        return fill(text, width)
 
 
-def format_latex(lines, width=80):
-    """Re-format lines of Latex text
+def format_paragraph(lines, width=80, open_groups=0):
+    """Re-format a single paragraph of Latex text
 
     Args:
-        lines (iterable): An iterable of lines
+        lines (iterable): An iterable of the (non-blank) lines in the
+            paragraph
         width (int): width at which to wrap
+        open_groups (int): number of groups that are open at the beginning of
+            the paragraph
+
+    Returns:
+        A tuple `out_buffer`, `open_groups`, where `out_buffer` is a list of
+        re-formatted chunks of text, and `open_groups` is the number of groups
+        that are still open at the end of the paragraph
     """
-    logger = logging.getLogger(__name__)
+    # TODO: determine indent
     out_buffer = []
-    open_groups = 0
-    cat_buffer = ''  # accumulated line
-    protect = False
-    new_par = True
+    cat_buffer = []  # accumulated fragments of text
     for line in lines:
-        assert line.endswith("\n")
-        if len(line.strip()) == 0:
-            logger.debug("Read blank line")
-            new_par = True
-            if len(cat_buffer) > 0:
-                out_text = reflow(cat_buffer, width, protect)
-                logger.debug("Adding to out_buffer: %s", repr(out_text))
-                out_buffer.append(out_text)
-            logger.debug("Adding to out_buffer: '' (paragraph end)")
-            out_buffer.append("")
-            cat_buffer, protect = '', False
-        else:
-            # TODO: determine indent if new_par
-            new_par = False
-            while len(line) > 0:
-                cat_buffer, line, open_groups, ready_for_output, protect \
-                    = process_line(cat_buffer, line, open_groups)
-                if ready_for_output:
-                    out_text = reflow(cat_buffer, width, protect)
-                    logger.debug("Adding to out_buffer: %s", repr(out_text))
-                    out_buffer.append(out_text)
-                    cat_buffer, protect = '', False
+        for (fragments, protect, open_groups) in process_line(
+                line, cat_buffer, open_groups):
+            out_text = reflow(fragments, width, protect)
+            logger.debug("Adding to out_buffer: %r", out_text)
+            out_buffer.append(out_text)
     if len(cat_buffer) > 0:
-        out_text = reflow(cat_buffer, width, protect)
-        logger.debug("Adding to out_buffer: %s", repr(out_text))
+        out_text = reflow(cat_buffer, width, False)
+        logger.debug("Adding to out_buffer: %r", out_text)
         out_buffer.append(out_text)
-    return "\n".join(out_buffer)
+    return out_buffer, open_groups
+
+
+def iter_lines(stream, block_size=BLOCK_SIZE):
+    """Iterate over the lines in the text `stream`, reading it in blocks of
+    `block_size` characters"""
+    carry = ''  # incomplete last line of the previous block
+    for block in iter(functools.partial(stream.read, block_size), ''):
+        lines = (carry + block).split("\n")
+        carry = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    if len(carry) > 0:
+        yield carry
+
+
+def is_blank(line):
+    """Check whether the given `line` is empty or contains only whitespace"""
+    return len(line) == 0 or line.isspace()
+
+
+def iter_format_latex(lines, width=80, jobs=1):
+    """Iterate over the re-formatted chunks of the given lines of Latex text
+
+    Args:
+        lines (iterable): An iterable of lines
+        width (int): width at which to wrap
+        jobs (int): number of processes to use for re-formatting paragraphs
+
+    Each chunk (one or more lines of output, without a trailing newline) is
+    generated as soon as the paragraph it belongs to has been read. For `jobs`
+    > 1, all `lines` are read first, and the paragraphs are re-formatted in
+    parallel.
+    """
+    blocks = itertools.groupby(lines, key=is_blank)
+    results = None
+    if jobs > 1:
+        blocks = [(blank, list(block)) for (blank, block) in blocks]
+        paragraphs = [block for (blank, block) in blocks if not blank]
+        with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+            # This assumes that no groups are open at the beginning of any
+            # paragraph. Paragraphs for which that is wrong are re-formatted
+            # again below
+            results = iter(list(executor.map(
+                functools.partial(format_paragraph, width=width), paragraphs,
+                chunksize=16)))
+    open_groups = 0
+    for (blank, block) in blocks:
+        if blank:
+            for line in block:
+                logger.debug("Read blank line")
+                yield ""
+        else:
+            if results is not None:
+                paragraph, end_groups = next(results)
+            if results is None or open_groups != 0:
+                paragraph, end_groups = format_paragraph(
+                    block, width, open_groups)
+            open_groups = end_groups
+            for out_text in paragraph:
+                yield out_text
+
+
+def format_latex(lines, width=80, jobs=1):
+    """Re-format lines of Latex text
+
+    Args:
+        lines (iterable): An iterable of lines
+        width (int): width at which to wrap
+        jobs (int): number of processes to use for re-formatting paragraphs
+    """
+    return "\n".join(iter_format_latex(lines, width=width, jobs=jobs))
 
 
 @click.command()
 @click.help_option('--help', '-h')
 @click.option(
     '--debug', is_flag=True, help='enable debug logging')
+@click.option(
+    '--jobs', '-j', type=click.IntRange(1), default=1, show_default=True,
+    help=('number of processes to use for re-formatting paragraphs. With more '
+          'than one job, the entire input is read before any output is '
+          'written'))
 @click.argument('input', type=click.File('r'), default='-')
 @click.argument('output', type=click.File('w'), default='-')
-def main(debug, input, output):
+def main(debug, jobs, input, output):
     """Format LaTeX source code
 
     Read from INFILE and write to OUTFILE. If INFILE and/or OUTFILE are omitted
@@ -205,11 +319,12 @@ def main(debug, input, output):
     """
     # TODO: standalone or snippet option that ignores header
     logging.basicConfig(level=logging.WARNING)
-    logger = logging.getLogger(__name__)
     if debug:
         logger.setLevel(logging.DEBUG)
         logger.debug("Enabled debug output")
-    sys.stdout.write(format_latex(fileinput.input()))
+    output.writelines(
+        out_text + "\n" for out_text
+        in iter_format_latex(iter_lines(input), jobs=jobs))
 
 
 if __name__ == "__main__":
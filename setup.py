@@ -1,6 +1,19 @@
 #!/usr/bin/env python
 import setuptools
 
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    ext_modules = []
+else:
+    # If Cython is available at build time, also compile fmtlatex.py into an
+    # extension module, which takes precedence over the pure-Python module on
+    # import
+    ext_modules = cythonize(
+        'fmtlatex.py', compiler_directives={'language_level': 3})
+    for ext in ext_modules:
+        # fall back to the pure-Python module if the extension cannot be built
+        ext.optional = True
 
 setuptools.setup(
     name="fmtlatex",
@@ -13,6 +26,7 @@ setuptools.setup(
     ],
     extras_require={'dev': ['pytest',]},
     py_modules=['fmtlatex'],
+    ext_modules=ext_modules,
     entry_points='''
         [console_scripts]
         fmtlatex=fmtlatex:main
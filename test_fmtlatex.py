@@ -1,7 +1,8 @@
 """Collection of tests for fmtlatex.py"""
 from click.testing import CliRunner
-from fmtlatex import format_latex, main
+from fmtlatex import format_latex, iter_lines, main
 from textwrap import dedent
+from io import StringIO
 import pytest
 
 
@@ -15,6 +16,28 @@ def test_help():
     assert result.output == result2.output
 
 
+def test_cli():
+    """Ensure that the command line interface re-formats its input"""
+    runner = CliRunner()
+    text_in = (
+        'In this paper, we consider a\nnetwork consisting of a cascade\n'
+        'of cavities. The network is depicted\nin \\Fig{network}.\n')
+    result = runner.invoke(main, input=text_in)
+    assert result.exit_code == 0
+    assert result.output == (
+        'In this paper, we consider a network consisting of a cascade of '
+        'cavities.\nThe network is depicted in \\Fig{network}.\n')
+
+
+def test_iter_lines():
+    """Ensure that reading in blocks splits the input at line breaks only"""
+    text = 'first line\n\nthird line\nno newline'
+    for block_size in [1, 3, 11, 100]:
+        lines = list(iter_lines(StringIO(text), block_size=block_size))
+        assert lines == ['first line\n', '\n', 'third line\n', 'no newline']
+    assert list(iter_lines(StringIO(''))) == []
+
+
 def to_lines(multiline_str):
     for line in multiline_str.split("\n"):
         yield line + "\n"
@@ -165,3 +188,64 @@ def test_blank_lines():
     result = format_latex(to_lines(text_in))
     assert result == expected
     assert(format_latex(to_lines(result))) == expected
+
+
+def test_escaped_percent():
+    text_in = dedent(r'''
+    The fidelity reaches 99\%
+    for all cavities.
+    %The network is depicted in \Fig{network}.
+    ''').strip()
+    expected = (
+        'The fidelity reaches 99\\% for all cavities.\n%The network is '
+        'depicted in \\Fig{network}.')
+    result = format_latex(to_lines(text_in))
+    assert result == expected
+    assert(format_latex(to_lines(result))) == expected
+
+
+def test_sentence_before_section():
+    text_in = dedent(r'''
+    This concludes the
+    introduction. \section{Model} We now
+    describe the model.
+    ''').strip()
+    expected = (
+        'This concludes the introduction.\n\\section{Model} We now\n'
+        'describe the model.')
+    result = format_latex(to_lines(text_in))
+    assert result == expected
+    assert(format_latex(to_lines(result))) == expected
+
+
+def test_parallel():
+    """Ensure that re-formatting paragraphs in parallel gives the same result
+    as re-formatting them sequentially, including for a group that spans
+    several paragraphs"""
+    text_in = dedent(r'''
+    In this paper, we consider a
+    network consisting of a cascade of cavities.
+
+    \begin{align}
+      a &= b
+
+      c &= d
+    \end{align}
+
+    The network is depicted
+    in \Fig{network}.
+    ''').strip()
+    expected = (
+        'In this paper, we consider a network consisting of a cascade of '
+        'cavities.\n\n\\begin{align}\n  a &= b\n\n  c &= d\n'
+        '\\end{align}\n\nThe network is depicted in \\Fig{network}.')
+    assert format_latex(to_lines(text_in)) == expected
+    assert format_latex(to_lines(text_in), jobs=2) == expected
+
+
+def test_invalid_jobs():
+    """Ensure that the number of jobs must be positive"""
+    runner = CliRunner()
+    for jobs in ['0', '-3']:
+        result = runner.invoke(main, args=['--jobs', jobs], input='')
+        assert result.exit_code != 0